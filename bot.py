@@ -1,33 +1,351 @@
 import discord
 import google.generativeai as genai
+from google.generativeai.types import content_types
 from discord.ext import commands
 import aiohttp
+import asyncio
+import os
 import traceback
 from config import *
 from discord import app_commands
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Set, Tuple, AsyncIterator, TYPE_CHECKING
+from contextlib import aclosing
 import shelve
+import dbm
+import threading
+import signal
+import sqlite3
+import orjson
+import base64
+import hashlib
+import functools
+import weakref
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import time
+from collections import OrderedDict
+# numpy is only needed by the optional semantic cache
+if TYPE_CHECKING:
+	import numpy as np
 
 #---------------------------------------------AI Configuration-------------------------------------------------
 genai.configure(api_key=GOOGLE_AI_KEY)
 
 model = genai.GenerativeModel(model_name="gemini-1.5-flash", generation_config=text_generation_config, safety_settings=safety_settings)
 
+# bot_template never changes, so convert it to Content once instead of on every new chat.
+# Every chat shares these same objects, so the prefix sent to the model is identical between channels.
+template_contents = tuple(content_types.to_contents(bot_template))
+
+@functools.lru_cache(maxsize=128)
+def get_persona_template(persona:str) -> Tuple:
+	# bot_template followed by the persona turns, converted once per persona
+	return (*template_contents, *content_types.to_contents([{'role':'user','parts': ["Forget what I said earlier! You are "+persona]}, {'role':'model','parts': ["Ok!"]}]))
+
+# Chats of recently active channels, others are loaded from the database when needed
 message_history:Dict[int, genai.ChatSession] = {}
-tracked_threads = []
+# Last and second to last time each loaded chat was used
+chat_access_times:Dict[int, Tuple[float, float]] = {}
+tracked_threads:Set[int] = set()
+
+#---------------------------------------------Error Logging-------------------------------------------------
+# Errors are written to errors.log by a background thread so logging never blocks the event loop
+error_handler = RotatingFileHandler('errors.log', maxBytes=5_000_000, backupCount=3, encoding='utf-8', delay=True)
+error_handler.setFormatter(logging.Formatter('\n##########################\n%(asctime)s\n%(message)s'))
+error_queue = queue.Queue()
+error_listener = QueueListener(error_queue, error_handler)
+error_listener.start()
+
+logger = logging.getLogger('gemini-bot')
+logger.addHandler(QueueHandler(error_queue))
+logger.propagate = False
+
+#---------------------------------------------Chat Data-------------------------------------------------
+# Each history entry is one row, so saving a reply only appends the new turns
+db = sqlite3.connect('chatdata.sqlite3', isolation_level=None, check_same_thread=False)
+db.execute('PRAGMA journal_mode=WAL')
+db.execute('PRAGMA synchronous=NORMAL')
+db.execute('CREATE TABLE IF NOT EXISTS messages(channel_id INTEGER, seq INTEGER, role TEXT, parts TEXT, PRIMARY KEY(channel_id, seq))')
+db.execute('CREATE TABLE IF NOT EXISTS tracked_threads(thread_id INTEGER PRIMARY KEY)')
+# Length of the fixed start of a channel's history when it differs from bot_template (a /forget persona)
+db.execute('CREATE TABLE IF NOT EXISTS channels(channel_id INTEGER PRIMARY KEY, prefix_length INTEGER)')
+# Serializes use of the connection between the writer and reader threads
+db_lock = threading.Lock()
+
+# Number of history entries already stored per channel
+saved_lengths:Dict[int, int] = {}
+# Turns dropped from the middle of a channel's history, the stored seq of history[i] past the prefix is i + offset
+seq_offsets:Dict[int, int] = {}
+prefix_lengths:Dict[int, int] = {}
+# Pending (channel_id, statement, rows) writes, applied in order by write_chatdata
+chatdata_queue:asyncio.Queue = asyncio.Queue()
+# Number of queued writes per channel that haven't reached the database yet
+pending_writes:Dict[int, int] = {}
+# Notified after each batch of writes is committed
+chatdata_written = asyncio.Condition()
+# Set to commit queued writes without waiting for more to gather
+chatdata_flush = asyncio.Event()
+
+def queue_chatdata(channel_id, statement, rows):
+	pending_writes[channel_id] = pending_writes.get(channel_id, 0) + 1
+	chatdata_queue.put_nowait((channel_id, statement, rows))
+
+async def wait_for_chatdata(channel_id):
+	# Returns once the channel's queued writes are in the database
+	if channel_id not in pending_writes:
+		return
+	chatdata_flush.set()
+	async with chatdata_written:
+		await chatdata_written.wait_for(lambda: channel_id not in pending_writes)
+
+def dump_parts(content) -> bytes:
+	parts = []
+	for part in content.parts:
+		if 'inline_data' in part:
+			parts.append({'mime_type': part.inline_data.mime_type, 'data': base64.b64encode(part.inline_data.data).decode()})
+		else:
+			parts.append({'text': part.text})
+	return orjson.dumps(parts)
+
+def load_parts(parts) -> list:
+	return [{'mime_type': part['mime_type'], 'data': base64.b64decode(part['data'])} if 'data' in part else part for part in orjson.loads(parts)]
+
+def import_shelve():
+	# Carry over chat data saved by older versions of the bot
+	try:
+		file = shelve.open('chatdata', 'r')
+	except dbm.error:
+		return
+	with file:
+		for key in file.keys():
+			if key.isnumeric():
+				db.executemany('INSERT OR REPLACE INTO messages VALUES(?, ?, ?, ?)', [(int(key), seq, content.role, dump_parts(content)) for seq, content in enumerate(file[key])])
+		db.executemany('INSERT OR IGNORE INTO tracked_threads VALUES(?)', [(thread_id,) for thread_id in file.get('tracked_threads', [])])
+
+if db.execute('SELECT 1 FROM messages LIMIT 1').fetchone() is None:
+	import_shelve()
+
+prefix_lengths = dict(db.execute('SELECT channel_id, prefix_length FROM channels'))
+tracked_threads = {thread_id for (thread_id,) in db.execute('SELECT thread_id FROM tracked_threads')}
+
+def load_chat_history(channel_id) -> Tuple[list, int]:
+	# Returns the stored history and its seq offset
+	with db_lock:
+		rows = db.execute('SELECT seq, role, parts FROM messages WHERE channel_id = ? ORDER BY seq', (channel_id,)).fetchall()
+	history = [{'role': role, 'parts': load_parts(parts)} for _, role, parts in rows]
+	return history, rows[-1][0] + 1 - len(rows) if rows else 0
 
-with shelve.open('chatdata') as file:
-	if 'tracked_threads' in file:
-		tracked_threads = file['tracked_threads']
-	for key in file.keys():
-		if key.isnumeric():
-			message_history[int(key)] = model.start_chat(history=file[key])
+async def get_chat(channel_id) -> genai.ChatSession:
+	if channel_id in message_history:
+		touch_chat(channel_id)
+		return message_history[channel_id]
+	# Make sure pending writes for this channel have landed before reading it back
+	await wait_for_chatdata(channel_id)
+	history, seq_offset = await asyncio.to_thread(load_chat_history, channel_id)
+	if channel_id in message_history:
+		return message_history[channel_id]
+	if history:
+		saved_lengths[channel_id] = len(history)
+	if seq_offset:
+		seq_offsets[channel_id] = seq_offset
+	chat = model.start_chat(history=history or template_contents)
+	add_chat(channel_id, chat)
+	return chat
+
+def touch_chat(channel_id):
+	last_access, _ = chat_access_times.get(channel_id, (float('-inf'), float('-inf')))
+	chat_access_times[channel_id] = (time.monotonic(), last_access)
+
+def add_chat(channel_id, chat):
+	message_history[channel_id] = chat
+	touch_chat(channel_id)
+	# Unload chats by their second to last use (LRU-2), so a burst of one-off channels
+	# only evicts each other instead of the conversations that keep coming back
+	while len(message_history) > max_cached_channels:
+		# A channel with a lock has a message or /forget holding or waiting on it, locked() alone misses the waiters
+		candidates = [victim for victim in message_history if victim != channel_id and victim not in channel_locks]
+		if not candidates:
+			break
+		unload_chat(min(candidates, key=lambda victim: chat_access_times[victim][::-1]))
+
+def unload_chat(channel_id):
+	save_chat_history(channel_id, message_history[channel_id].history)
+	message_history.pop(channel_id)
+	chat_access_times.pop(channel_id, None)
+	saved_lengths.pop(channel_id, None)
+	seq_offsets.pop(channel_id, None)
+	embedding_cache.pop(channel_id, None)
+
+def get_prefix_length(channel_id) -> int:
+	return prefix_lengths.get(channel_id, len(template_contents))
+
+def get_seq(channel_id, index) -> int:
+	return index + seq_offsets.get(channel_id, 0) if index >= get_prefix_length(channel_id) else index
+
+def save_chat_history(channel_id, history):
+	start = saved_lengths.get(channel_id, 0)
+	saved_lengths[channel_id] = len(history)
+	# Rows are encoded lazily by the writer thread, off the event loop
+	new_rows = [(get_seq(channel_id, index), content) for index, content in enumerate(history[start:], start)]
+	queue_chatdata(channel_id, 'INSERT OR REPLACE INTO messages VALUES(?, ?, ?, ?)', ((channel_id, seq, content.role, dump_parts(content)) for seq, content in new_rows))
+
+def delete_chat_history(channel_id):
+	saved_lengths.pop(channel_id, None)
+	seq_offsets.pop(channel_id, None)
+	prefix_lengths.pop(channel_id, None)
+	queue_chatdata(channel_id, 'DELETE FROM messages WHERE channel_id = ?', [(channel_id,)])
+	queue_chatdata(channel_id, 'DELETE FROM channels WHERE channel_id = ?', [(channel_id,)])
+
+def save_prefix_length(channel_id, prefix_length):
+	prefix_lengths[channel_id] = prefix_length
+	queue_chatdata(channel_id, 'INSERT OR REPLACE INTO channels VALUES(?, ?)', [(channel_id, prefix_length)])
+
+def trim_chat_history(channel_id, chat:genai.ChatSession) -> list:
+	# Keep the template and the last max_history_turns exchanges, the model is billed for the whole history every turn.
+	# Returns the history the channel ends up with.
+	history = chat.history
+	prefix_length = get_prefix_length(channel_id)
+	if max_history_turns is None or len(history) <= prefix_length + 2 * max_history_turns:
+		return history
+	dropped = len(history) - prefix_length - 2 * max_history_turns
+	history = history[:prefix_length] + history[-2 * max_history_turns:]
+	message_history[channel_id] = model.start_chat(history=history)
+	first_seq = get_seq(channel_id, prefix_length)
+	queue_chatdata(channel_id, 'DELETE FROM messages WHERE channel_id = ? AND seq >= ? AND seq < ?', [(channel_id, first_seq, first_seq + dropped)])
+	seq_offsets[channel_id] = seq_offsets.get(channel_id, 0) + dropped
+	if saved_lengths.get(channel_id, 0) > prefix_length:
+		saved_lengths[channel_id] = max(saved_lengths[channel_id] - dropped, prefix_length)
+	return history
+
+def save_tracked_thread(thread_id):
+	queue_chatdata(None, 'INSERT OR IGNORE INTO tracked_threads VALUES(?)', [(thread_id,)])
+
+def commit_chatdata(writes):
+	# One transaction, and so one sync to disk, for all the writes
+	db.execute('BEGIN')
+	try:
+		for _, statement, rows in writes:
+			if rows is not None:
+				db.executemany(statement, rows)
+	except BaseException:
+		db.execute('ROLLBACK')
+		raise
+	db.execute('COMMIT')
+
+def execute_chatdata(writes) -> Tuple[list, list]:
+	# Returns the writes with their rows encoded, so failed ones can be retried, and for each one
+	# whether it was saved (True), failed (False) or couldn't be encoded and is dropped (None)
+	encoded = []
+	for channel_id, statement, rows in writes:
+		try:
+			rows = list(rows)
+		except Exception:
+			logger.exception('Error encoding chat data for channel %s', channel_id)
+			rows = None
+		encoded.append((channel_id, statement, rows))
+	with db_lock:
+		try:
+			commit_chatdata(encoded)
+			return encoded, [True if rows is not None else None for _, _, rows in encoded]
+		except Exception:
+			logger.exception('Error saving chat data, retrying the writes one at a time')
+		# Commit each write alone so one failure doesn't take the rest of the batch with it.
+		# After a channel's write fails its later writes wait too, so they stay in order.
+		saved = []
+		failed_channels = set()
+		for write in encoded:
+			channel_id, _, rows = write
+			if rows is None:
+				saved.append(None)
+			elif channel_id in failed_channels:
+				saved.append(False)
+			else:
+				try:
+					commit_chatdata([write])
+					saved.append(True)
+				except Exception:
+					failed_channels.add(channel_id)
+					saved.append(False)
+	return encoded, saved
+
+async def write_chatdata():
+	# Failed writes with their number of attempts, retried ahead of newer writes
+	retries = []
+	while True:
+		if retries:
+			batch = retries
+			delay = 5
+		else:
+			batch = [(0, await chatdata_queue.get())]
+			delay = 0.2
+		# Let a burst of writes from busy channels gather before committing, unless someone is waiting on them
+		try:
+			await asyncio.wait_for(chatdata_flush.wait(), delay)
+		except asyncio.TimeoutError:
+			pass
+		chatdata_flush.clear()
+		while not chatdata_queue.empty():
+			batch.append((0, chatdata_queue.get_nowait()))
+		writes, saved = await asyncio.to_thread(execute_chatdata, [write for _, write in batch])
+		retries = []
+		failed_channels = set()
+		for (attempts, _), write, write_saved in zip(batch, writes, saved):
+			channel_id = write[0]
+			if write_saved is False:
+				# Only a channel's first failed write was tried, the ones after it just waited
+				if channel_id not in failed_channels:
+					failed_channels.add(channel_id)
+					attempts += 1
+				if attempts < 3:
+					retries.append((attempts, write))
+					continue
+			if not write_saved:
+				logger.error('Gave up saving chat data for channel %s', channel_id)
+				# Send the channel's whole history again with its next save
+				saved_lengths.pop(channel_id, None)
+			pending_writes[channel_id] -= 1
+			if not pending_writes[channel_id]:
+				del pending_writes[channel_id]
+			chatdata_queue.task_done()
+		async with chatdata_written:
+			chatdata_written.notify_all()
 
 #---------------------------------------------Discord Code-------------------------------------------------
+class GeminiBot(commands.Bot):
+	async def setup_hook(self):
+		get_http_session()
+		self.chatdata_writer = asyncio.create_task(write_chatdata())
+		self.model_warm_up = asyncio.create_task(warm_up_model())
+		# Shut down cleanly when stopped by a service manager, so queued chat data is written
+		self.close_task = None
+		try:
+			asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self.close_on_signal)
+		except NotImplementedError:
+			pass
+
+	def close_on_signal(self):
+		# Keep a reference so the task isn't garbage collected while it runs
+		if self.close_task is None:
+			self.close_task = asyncio.create_task(self.close())
+
+	async def close(self):
+		# Let pending chat data reach the database before exiting
+		chatdata_flush.set()
+		await chatdata_queue.join()
+		try:
+			await super().close()
+		finally:
+			# bot.run can cancel this task once the gateway is closed, so the synchronous cleanup goes first.
+			# The HTTP session is closed last, when no new message can open another one.
+			db.close()
+			error_listener.stop()
+			await close_http_session()
+
 # Initialize Discord bot
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix=[], intents=intents,help_command=None,activity=discord.Game('with your feelings'))
+bot = GeminiBot(command_prefix=(), intents=intents,help_command=None,activity=discord.Game('with your feelings'))
 
 #On Message Function
 @bot.event
@@ -38,15 +356,16 @@ async def on_message(message: discord.Message):
 	# Ignore messages sent to everyone
 	if message.mention_everyone:
 		return
-	# Check if the bot is mentioned or the message is a DM
-	if not (bot.user.mentioned_in(message) or isinstance(message.channel, discord.DMChannel) or message.channel.id in tracked_channels or message.channel.id in tracked_threads):
+	# Check if the message is a DM, in a tracked channel or thread, or mentions the bot.
+	# The mention check scans the message's mentions, so it goes last.
+	channel_id = message.channel.id
+	if not (isinstance(message.channel, discord.DMChannel) or channel_id in tracked_channels or channel_id in tracked_threads or bot.user.mentioned_in(message)):
 		return
 	# Start Typing to seem like something happened
 	try:
 		async with message.channel.typing():
 			print("FROM:" + str(message.author.name) + ": " + message.content)
 			query = ""
-			attachments = []
 
 			# Check if the message has attachments
 			if not message.attachments:
@@ -57,126 +376,342 @@ async def on_message(message: discord.Message):
 					query = f"@{message.author.name} sent attachments:"
 				else:
 					query = f"@{message.author.name} said \"{message.clean_content}\" while sending attachments:"
-				attachments = await get_attachment_data(message.attachments)
-				if not attachments:
-					await message.channel.send("An error occurred while processing your attachments.")
-					return
-				if len(attachments) == 0:
-					await message.channel.send("Attachments are of unsupported file types.")
-					return
 
 			# Check if message is quoting someone
+			reply_message = None
 			if message.reference is not None:
-				reply_message = await message.channel.fetch_message(message.reference.message_id)
+				# Discord usually sends the quoted message along, only fetch it when it didn't
+				reply_message = message.reference.resolved
+				if not isinstance(reply_message, discord.Message):
+					reply_message = await message.channel.fetch_message(message.reference.message_id)
 				if reply_message.author.id != bot.user.id:
 					query = f"{query} while quoting @{reply_message.author.name} \"{reply_message.clean_content}\""
-				if reply_message.attachments:
-					attachments += await get_attachment_data(reply_message.attachments)
 
-			# Generate response using Gemini API
-			response_text = await generate_response(message.channel.id, attachments, query)
+			# Download the message's and the quoted message's attachments at the same time
+			attachments, quoted_attachments = await asyncio.gather(
+				get_attachment_data(message.attachments),
+				get_attachment_data(reply_message.attachments if reply_message else []),
+			)
+			if attachments is None or quoted_attachments is None:
+				await message.channel.send("An error occurred while processing your attachments.")
+				return
+			if message.attachments and len(attachments) == 0:
+				if any(get_mime_type(attachment.filename) and attachment.size > max_attachment_size for attachment in message.attachments):
+					await message.channel.send(f"Attachments are too large, the limit is {max_attachment_size // (1024 * 1024)} MB.")
+				else:
+					await message.channel.send("Attachments are of unsupported file types.")
+				return
+			attachments += quoted_attachments
 
-			await split_and_send_messages(message, response_text, 1700)
-			with shelve.open('chatdata') as file:
-				file[str(message.channel.id)] = message_history[message.channel.id].history
+			# Generate response using Gemini API
+			async with aclosing(generate_response(message.channel.id, attachments, query)) as response_chunks:
+				if stream_responses:
+					await stream_and_send_messages(message, response_chunks, 1700)
+				else:
+					await split_and_send_messages(message, ''.join([chunk async for chunk in response_chunks]), 1700)
 	except Exception as e:
 		print(f"Error: {e}")
 		print(traceback.format_exc())
-		if e.code == 50035:
+		if getattr(e, 'code', None) == 50035:
 			await message.channel.send("The message is too long for me to process.")
 		else:
 			await message.channel.send('An error occurred while processing your message.')
 
 
-async def get_attachment_data(attachments:List[discord.Attachment]) -> List[Dict[str, bytes]]:
-	result = []
-	for attachment in attachments:
-		async with aiohttp.ClientSession() as session:
-			async with session.get(attachment.url) as resp:
-				if resp.status != 200:
-					return None
-				attachment_data = await resp.read()
-				mime_type = None
-				if any(attachment.filename.lower().endswith(ext) for ext in ['.png', '.jpeg', '.heic', '.webp', '.heif']):
-					mime_type = f"image/{attachment.filename.split('.')[-1]}"
-				elif any(attachment.filename.lower().endswith(ext) for ext in ['.jpg']):
-					mime_type = "image/jpeg"
-				elif any(attachment.filename.lower().endswith(ext) for ext in ['.wav', '.mp3', '.aiff', '.aac', '.ogg', '.flac']):
-					mime_type = f"audio/{attachment.filename.split('.')[-1]}"
-				elif any(attachment.filename.lower().endswith(ext) for ext in ['.html', '.css', '.md', '.csv', '.xml', '.rtf']):
-					mime_type = f"text/{attachment.filename.split('.')[-1]}"
-				elif any(attachment.filename.lower().endswith(ext) for ext in ['.pdf']):
-					mime_type = "application/pdf"
-				elif any(attachment.filename.lower().endswith(ext) for ext in ['.js']):
-					mime_type = "application/x-javascript"
-				elif any(attachment.filename.lower().endswith(ext) for ext in ['.py']):
-					mime_type = "application/x-python"
-				if mime_type:
-					result.append({"mime_type": mime_type, "data": attachment_data})
-	return result
+# Supported attachment extensions and their MIME types
+MIME_TYPES: Dict[str, str] = {
+	**{ext: f"image/{ext[1:]}" for ext in ['.png', '.jpeg', '.heic', '.webp', '.heif']},
+	'.jpg': "image/jpeg",
+	**{ext: f"audio/{ext[1:]}" for ext in ['.wav', '.mp3', '.aiff', '.aac', '.ogg', '.flac']},
+	**{ext: f"text/{ext[1:]}" for ext in ['.html', '.css', '.md', '.csv', '.xml', '.rtf']},
+	'.pdf': "application/pdf",
+	'.js': "application/x-javascript",
+	'.py': "application/x-python",
+}
+
+def get_mime_type(filename:str) -> Optional[str]:
+	return MIME_TYPES.get(os.path.splitext(filename)[1].lower())
+
+# Shared HTTP session, reused for every attachment download
+http_session: Optional[aiohttp.ClientSession] = None
+
+def get_http_session() -> aiohttp.ClientSession:
+	global http_session
+	if http_session is None or http_session.closed:
+		http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=75))
+	return http_session
+
+async def close_http_session():
+	if http_session is not None and not http_session.closed:
+		await http_session.close()
+
+async def get_attachment_data(attachments:List[discord.Attachment]) -> Optional[List[Dict[str, bytes]]]:
+	session = get_http_session()
+	results = await asyncio.gather(*[fetch_attachment(session, attachment) for attachment in attachments], return_exceptions=True)
+	# Fail the whole message if any download failed
+	if any(isinstance(result, BaseException) for result in results):
+		return None
+	return [result for result in results if result is not None]
+
+# Recently downloaded attachment bytes by attachment id (signed CDN URLs change, ids don't)
+attachment_cache:OrderedDict[int, bytes] = OrderedDict()
+attachment_cache_bytes = 0
+
+def cache_attachment(attachment_id, data:bytes):
+	global attachment_cache_bytes
+	if len(data) > attachment_cache_size:
+		return
+	if attachment_id in attachment_cache:
+		attachment_cache_bytes -= len(attachment_cache.pop(attachment_id))
+	attachment_cache[attachment_id] = data
+	attachment_cache_bytes += len(data)
+	while attachment_cache_bytes > attachment_cache_size:
+		attachment_cache_bytes -= len(attachment_cache.popitem(last=False)[1])
+
+async def fetch_attachment(session:aiohttp.ClientSession, attachment:discord.Attachment) -> Optional[Dict[str, bytes]]:
+	# Skip unsupported and oversized files before downloading them
+	mime_type = get_mime_type(attachment.filename)
+	if not mime_type or attachment.size > max_attachment_size:
+		return None
+	if attachment.id in attachment_cache:
+		attachment_cache.move_to_end(attachment.id)
+		attachment_data = attachment_cache[attachment.id]
+	else:
+		async with session.get(attachment.url) as resp:
+			resp.raise_for_status()
+			attachment_data = await resp.read()
+		cache_attachment(attachment.id, attachment_data)
+	return {"mime_type": mime_type, "data": attachment_data}
 
 #---------------------------------------------AI Generation History-------------------------------------------------		   
 
-async def generate_response(channel_id,attachments,text):
+async def warm_up_model():
+	# Open the connection to Gemini before the first message needs it (count_tokens is free)
+	try:
+		await model.count_tokens_async("Hello")
+	except Exception as e:
+		print(f"Error warming up model: {e}")
+
+# One lock per channel so concurrent messages don't interleave on the same chat session.
+# A lock only lives while a message or /forget holds or waits on it.
+channel_locks:weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+
+def get_channel_lock(channel_id) -> asyncio.Lock:
+	lock = channel_locks.get(channel_id)
+	if lock is None:
+		lock = channel_locks[channel_id] = asyncio.Lock()
+	return lock
+
+# Recent responses keyed by channel and a hash of the tail of its history and the prompt
+response_cache:OrderedDict[Tuple[int, bytes], Tuple[float, str]] = OrderedDict()
+
+def get_response_cache_key(channel_id, history, prompt_parts) -> Tuple[int, bytes]:
+	key = hashlib.blake2b(digest_size=16)
+	for content in history[-4:]:
+		key.update(b'\0' + type(content).serialize(content))
+	for part in prompt_parts:
+		if isinstance(part, dict):
+			key.update(b'\0' + part['mime_type'].encode() + b'\0' + part['data'])
+		else:
+			key.update(b'\0' + part.encode())
+	return channel_id, key.digest()
+
+def get_cached_response(key) -> Optional[str]:
+	if key not in response_cache:
+		return None
+	created, response_text = response_cache[key]
+	if time.monotonic() - created > response_cache_ttl:
+		del response_cache[key]
+		return None
+	response_cache.move_to_end(key)
+	return response_text
+
+def cache_response(key, response_text):
+	response_cache[key] = (time.monotonic(), response_text)
+	response_cache.move_to_end(key)
+	while len(response_cache) > response_cache_size:
+		response_cache.popitem(last=False)
+
+def forget_cached_responses(channel_id):
+	for key in [key for key in response_cache if key[0] == channel_id]:
+		del response_cache[key]
+
+# Normalized embeddings of recent text prompts per channel, with the answers they got
+embedding_cache:Dict[int, Tuple['np.ndarray', List[str]]] = {}
+
+async def embed_prompt(text) -> Optional['np.ndarray']:
+	import numpy as np
+	try:
+		result = await genai.embed_content_async(model="models/text-embedding-004", content=text)
+	except Exception as e:
+		print(f"Error embedding prompt: {e}")
+		return None
+	embedding = np.asarray(result['embedding'], dtype=np.float32)
+	return embedding / np.linalg.norm(embedding)
+
+def get_similar_response(channel_id, embedding) -> Optional[str]:
+	if channel_id not in embedding_cache:
+		return None
+	embeddings, responses = embedding_cache[channel_id]
+	similarities = embeddings @ embedding
+	best = int(similarities.argmax())
+	if similarities[best] < semantic_cache_threshold:
+		return None
+	return responses[best]
+
+def cache_embedding(channel_id, embedding, response_text):
+	import numpy as np
+	if channel_id in embedding_cache:
+		embeddings, responses = embedding_cache[channel_id]
+		embeddings = np.vstack([embeddings, embedding])[-semantic_cache_size:]
+		responses = (responses + [response_text])[-semantic_cache_size:]
+	else:
+		embeddings, responses = embedding[np.newaxis], [response_text]
+	embedding_cache[channel_id] = (embeddings, responses)
+
+def describe_history(history) -> str:
+	# Attachments are logged as their size and long texts are cut, so formatting stays cheap
+	lines = []
+	for content in history:
+		parts = [f'<{part.inline_data.mime_type}, {len(part.inline_data.data)} bytes>' if 'inline_data' in part else repr(part.text[:1000]) for part in content.parts]
+		lines.append(f"{content.role}: {', '.join(parts)}")
+	return '\n'.join(lines)
+
+async def generate_response(channel_id,attachments,text) -> AsyncIterator[str]:
+	# Yields the response text piece by piece as Gemini streams it
+	response = None
 	try:
 		prompt_parts = attachments
 		prompt_parts.append(text)
-		if not (channel_id in message_history):
-			message_history[channel_id] = model.start_chat(history=bot_template)
-		response = await message_history[channel_id].send_message_async(prompt_parts)
-		return response.text
+		# Only plain text prompts are matched by meaning
+		embedding = None
+		if semantic_cache_threshold is not None and len(prompt_parts) == 1:
+			embedding = await embed_prompt(text)
+		async with get_channel_lock(channel_id):
+			chat = await get_chat(channel_id)
+			cache_key = get_response_cache_key(channel_id, chat.history, prompt_parts)
+			response_text = get_cached_response(cache_key)
+			if response_text is None and embedding is not None:
+				response_text = get_similar_response(channel_id, embedding)
+			if response_text is not None:
+				# Keep the conversation consistent as if the model had answered
+				chat.history = chat.history + [{'role':'user','parts': prompt_parts}, {'role':'model','parts': [response_text]}]
+				yield response_text
+				if message_history.get(channel_id) is chat:
+					save_chat_history(channel_id, trim_chat_history(channel_id, chat))
+				return
+			history = list(chat.history)
+			try:
+				response = await chat.send_message_async(prompt_parts, stream=True)
+				async for chunk in response:
+					yield chunk.text
+				# A stream that finished badly (SAFETY, RECITATION, ...) only raises once the history or text is read
+				chat.history
+				response_text = response.text
+			except BaseException:
+				# An unfinished stream leaves the chat unusable, start over from before this message
+				if message_history.get(channel_id) is chat:
+					message_history[channel_id] = model.start_chat(history=history)
+				raise
+			cache_response(cache_key, response_text)
+			if embedding is not None:
+				cache_embedding(channel_id, embedding, response_text)
+			# The chat may have been forgotten meanwhile, don't bring it back
+			if message_history.get(channel_id) is chat:
+				save_chat_history(channel_id, trim_chat_history(channel_id, chat))
 	except Exception as e:
-		with open('errors.log','a+',encoding='utf-8') as errorlog:
-			errorlog.write('\n##########################\n')
-			errorlog.write('Message: '+text)
-			errorlog.write('\n-------------------\n')
-			errorlog.write('Traceback:\n'+traceback.format_exc())
-			errorlog.write('\n-------------------\n')
-			errorlog.write(f'History:\n{str(message_history[channel_id].history)}')
-			errorlog.write('\n-------------------\n')
-			errorlog.write('Candidates:\n'+str(response.candidates))
-			errorlog.write('\n-------------------\n')
-			errorlog.write('Parts:\n'+str(response.parts))
-			errorlog.write('\n-------------------\n')
-			errorlog.write('Prompt feedbacks:\n'+str(response.prompt_feedbacks))
+		# Only the end of the history is logged, long-running channels can have huge histories
+		try:
+			history = describe_history(message_history[channel_id].history[-6:]) if channel_id in message_history else None
+		except Exception as history_error:
+			history = f"Unavailable: {history_error}"
+		separator = '\n-------------------\n'
+		logger.exception(separator.join([
+			'Message: %s',
+			'History (last 6 entries):\n%.4000s',
+			'Candidates:\n%.4000s',
+			'Prompt feedback:\n%s',
+		]), text, history, response and response.candidates, response and response.prompt_feedback)
+		raise
 
 @bot.tree.command(name='forget',description='Forget message history')
 @app_commands.describe(persona='Persona of bot')
 async def forget(interaction:discord.Interaction,persona:Optional[str] = None):
+	# Waiting for a reply in progress can take longer than Discord allows for a response
+	await interaction.response.defer()
 	try:
-		message_history.pop(interaction.channel_id)
-		if persona:
-			temp_template = bot_template.copy()
-			temp_template.append({'role':'user','parts': ["Forget what I said earlier! You are "+persona]})
-			temp_template.append({'role':'model','parts': ["Ok!"]})
-			message_history[interaction.channel_id] = model.start_chat(history=temp_template)
+		# Wait for any reply being generated in the channel, so it can't write the old chat back
+		async with get_channel_lock(interaction.channel_id):
+			embedding_cache.pop(interaction.channel_id, None)
+			# Asking again after /forget should get a new answer, not the one that was just rejected
+			forget_cached_responses(interaction.channel_id)
+			delete_chat_history(interaction.channel_id)
+			message_history.pop(interaction.channel_id, None)
+			chat_access_times.pop(interaction.channel_id, None)
+			if persona:
+				temp_template = get_persona_template(persona)
+				chat = model.start_chat(history=temp_template)
+				add_chat(interaction.channel_id, chat)
+				save_prefix_length(interaction.channel_id, len(temp_template))
+				# Store the persona right away so it matches the saved prefix length after a restart
+				save_chat_history(interaction.channel_id, chat.history)
 	except Exception as e:
 		pass
-	await interaction.response.send_message("Message history for channel erased.")
+	await interaction.followup.send("Message history for channel erased.")
 
 @bot.tree.command(name='createthread',description='Create a thread in which bot will respond to every message.')
 @app_commands.describe(name='Thread name')
 async def create_thread(interaction:discord.Interaction,name:str):
 	try:
 		thread = await interaction.channel.create_thread(name=name,auto_archive_duration=60)
-		tracked_threads.append(thread.id)
+		tracked_threads.add(thread.id)
 		await interaction.response.send_message(f"Thread {name} created!")
-		with shelve.open('chatdata') as file:	
-			file['tracked_threads'] = tracked_threads
+		save_tracked_thread(thread.id)
 	except Exception as e:
 		await interaction.response.send_message("Error creating thread!")
 
 #---------------------------------------------Sending Messages-------------------------------------------------
 async def split_and_send_messages(message_system:discord.Message, text, max_length):
-	# Split the string into parts
-	messages = []
+	# Send each part as a separate message, slicing them as we go.
+	# Discord orders messages by arrival, so the parts are sent one after another.
 	for i in range(0, len(text), max_length):
-		sub_message = text[i:i+max_length]
-		messages.append(sub_message)
+		await send_part(message_system, text[i:i+max_length], i == 0)
+
+async def stream_and_send_messages(message_system:discord.Message, chunks:AsyncIterator[str], max_length):
+	# Show the response while it is generated by editing the latest message in place
+	text = ''
+	shown = ''
+	current = None
+	first = True
+	last_edit = 0.0
+	async for chunk in chunks:
+		text += chunk
+		# Messages that are full are finished, later text goes into a new message
+		while len(text) > max_length:
+			await show_part(message_system, current, text[:max_length], first)
+			current = None
+			first = False
+			text = text[max_length:]
+			shown = ''
+		# Discord allows about 5 edits per 5 seconds
+		if text != shown and time.monotonic() - last_edit >= 1:
+			current = await show_part(message_system, current, text, first)
+			shown = text
+			last_edit = time.monotonic()
+	if text != shown:
+		await show_part(message_system, current, text, first)
+
+async def show_part(message_system:discord.Message, current:Optional[discord.Message], text, first) -> discord.Message:
+	if current is None:
+		return await send_part(message_system, text, first)
+	await current.edit(content=text)
+	return current
 
-	# Send each part as a separate message
-	for string in messages:
-		message_system = await message_system.reply(string)	
+async def send_part(message_system:discord.Message, text, first) -> discord.Message:
+	# Only the first part replies to the user, the rest follow it in the channel
+	if first:
+		return await message_system.reply(text)
+	return await message_system.channel.send(text)
 
 #---------------------------------------------Run Bot-------------------------------------------------
 @bot.event
@@ -1,16 +1,18 @@
 import os
 import dotenv
 
-dotenv.load_dotenv('.env')
-dotenv.load_dotenv('.env.development')
+# The .env files are only needed when the keys don't come from the environment already
+if not (os.getenv('GOOGLE_AI_KEY') and os.getenv('DISCORD_BOT_TOKEN')):
+	dotenv.load_dotenv('.env')
+	dotenv.load_dotenv('.env.development')
 
 GOOGLE_AI_KEY = os.getenv('GOOGLE_AI_KEY')
 DISCORD_BOT_TOKEN = os.getenv('DISCORD_BOT_TOKEN')
 
-tracked_channels = [
+tracked_channels = frozenset([
 	# channel_id_1,
 	# thread_id_2,
-]
+])
 
 text_generation_config = {
 	"temperature": 0.9,
@@ -24,6 +26,27 @@ image_generation_config = {
 	"top_k": 32,
 	# "max_output_tokens": 512,
 }
+# Number of channels whose chats are kept in memory, others are reloaded from chatdata.sqlite3 when used
+max_cached_channels = 512
+
+# Number of recent exchanges sent to the model along with bot_template, None to keep everything
+max_history_turns = 20
+
+# Show responses while they are being generated by editing the reply
+stream_responses = True
+
+# Attachments larger than this are ignored, Gemini accepts up to 20 MB of inline data per request
+max_attachment_size = 20 * 1024 * 1024 # bytes
+# Memory used to keep recently downloaded attachments, so quoting them again skips the download
+attachment_cache_size = 64 * 1024 * 1024 # bytes
+
+# Identical prompts in the same conversation state reuse the previous answer
+response_cache_size = 512
+response_cache_ttl = 10 * 60 # seconds
+# Reuse answers to paraphrased prompts, e.g. 0.92 cosine similarity (costs one embedding call per message)
+semantic_cache_threshold = None
+semantic_cache_size = 256
+
 safety_settings = [
 	# {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
 	# {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},